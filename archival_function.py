@@ -3,15 +3,36 @@ Azure Function for archiving old billing records from Cosmos DB to Blob Storage.
 This function runs on a schedule to identify and migrate records older than 3 months.
 """
 
+import asyncio
 import azure.functions as func
-import azure.cosmos.cosmos_client as cosmos_client
-from azure.storage.blob import BlobServiceClient
-import json
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.storage.blob.aio import BlobServiceClient
 import logging
+import orjson
 import os
-from datetime import datetime, timedelta
-import gzip
+import uuid
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
 import io
+import zlib
+import zstandard as zstd
+
+def load_zstd_dictionary():
+    """
+    Load the optional shared zstd dictionary. A dictionary trained on
+    sample billing JSON noticeably improves ratios on small records.
+    """
+    dict_path = os.environ.get('ZSTD_DICT_PATH')
+    if dict_path and os.path.exists(dict_path):
+        with open(dict_path, 'rb') as f:
+            return zstd.ZstdCompressionDict(f.read())
+    return None
+
+_ZSTD_DICT = load_zstd_dictionary()
+
+# Reused across batches so compression state is initialized once
+_COMPRESSOR = zstd.ZstdCompressor(level=10, dict_data=_ZSTD_DICT)
 
 # Configuration
 COSMOS_ENDPOINT = os.environ.get('COSMOS_ENDPOINT')
@@ -22,116 +43,317 @@ COSMOS_CONTAINER_NAME = os.environ.get('COSMOS_CONTAINER_NAME', 'records')
 BLOB_CONNECTION_STRING = os.environ.get('BLOB_CONNECTION_STRING')
 BLOB_CONTAINER_NAME = os.environ.get('BLOB_CONTAINER_NAME', 'archived-billing-records')
 
+ARCHIVE_INDEX_CONTAINER_NAME = os.environ.get('ARCHIVE_INDEX_CONTAINER_NAME', 'archive-index')
+
 ARCHIVE_THRESHOLD_MONTHS = int(os.environ.get('ARCHIVE_THRESHOLD_MONTHS', '3'))
 BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '100'))
+MAX_CONCURRENT_OPERATIONS = int(os.environ.get('MAX_CONCURRENT_OPERATIONS', '32'))
+ARCHIVE_PACK_BUCKETS = int(os.environ.get('ARCHIVE_PACK_BUCKETS', '16'))
+
+# Clients are created lazily and kept for the lifetime of the worker so the
+# Functions host reuses the SDK connection pools across invocations instead
+# of paying TLS and topology negotiation on every timer tick
+_clients_lock = asyncio.Lock()
+_cosmos_client = None
+_blob_service_client = None
+
+async def get_clients():
+    """
+    Return the shared CosmosClient and BlobServiceClient, creating them on
+    first use.
+    """
+    global _cosmos_client, _blob_service_client
 
-def main(mytimer: func.TimerRequest) -> None:
+    if _cosmos_client is None:
+        async with _clients_lock:
+            if _cosmos_client is None:
+                _blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
+                _cosmos_client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+
+    return _cosmos_client, _blob_service_client
+
+async def main(mytimer: func.TimerRequest) -> None:
     """
     Main function triggered by timer to archive old billing records.
     """
     logging.info('Starting billing records archival process')
-    
+
     try:
-        # Initialize clients
-        cosmos_client_instance = cosmos_client.CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+        # Shared clients, reused across invocations
+        cosmos_client_instance, blob_service_client = await get_clients()
         database = cosmos_client_instance.get_database_client(COSMOS_DATABASE_NAME)
         container = database.get_container_client(COSMOS_CONTAINER_NAME)
-        
-        blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
+        index_container = database.get_container_client(ARCHIVE_INDEX_CONTAINER_NAME)
         blob_container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
-        
+
         # Ensure blob container exists
         try:
-            blob_container_client.create_container()
+            await blob_container_client.create_container()
         except Exception:
             pass  # Container might already exist
-        
-        # Calculate cutoff date
-        cutoff_date = datetime.utcnow() - timedelta(days=ARCHIVE_THRESHOLD_MONTHS * 30)
+
+        # Ensure the archive index container exists; index entries are
+        # point read by record id, so it uses the same /id partition key
+        await database.create_container_if_not_exists(
+            id=ARCHIVE_INDEX_CONTAINER_NAME,
+            partition_key=PartitionKey(path='/id')
+        )
+
+        # Calculate cutoff date using a real calendar delta so the archival
+        # boundary does not drift the way days=months*30 does
+        cutoff_date = datetime.utcnow() - relativedelta(months=ARCHIVE_THRESHOLD_MONTHS)
         cutoff_timestamp = cutoff_date.isoformat()
-        
+
         logging.info(f'Archiving records older than {cutoff_timestamp}')
-        
-        # Query for old records
-        query = f"SELECT * FROM c WHERE c.created_date < '{cutoff_timestamp}'"
-        
+
+        # Query for old records (parameterized so the query plan is reused);
+        # records promoted back from the archive stay in Cosmos
+        query = ("SELECT * FROM c WHERE c.created_date < @cutoff "
+                 "AND NOT IS_DEFINED(c.promoted_from_archive)")
+        parameters = [{"name": "@cutoff", "value": cutoff_timestamp}]
+
         archived_count = 0
         failed_count = 0
-        
+
         # Process records in batches
-        for items in query_items_in_batches(container, query, BATCH_SIZE):
-            batch_results = process_batch(items, blob_container_client, container)
+        async for items in query_items_in_batches(container, query, parameters, BATCH_SIZE):
+            batch_results = await process_batch(items, blob_container_client, container, index_container)
             archived_count += batch_results['archived']
             failed_count += batch_results['failed']
-        
+
         logging.info(f'Archival process completed. Archived: {archived_count}, Failed: {failed_count}')
-        
+
     except Exception as e:
         logging.error(f'Error in archival process: {str(e)}')
         raise
 
-def query_items_in_batches(container, query, batch_size):
+async def query_items_in_batches(container, query, parameters, batch_size):
     """
     Query items from Cosmos DB in batches to manage memory usage.
+    Iterates the paged result lazily so memory stays bounded at batch_size
+    and archival can start as soon as the first page arrives.
     """
-    items = list(container.query_items(query=query, enable_cross_partition_query=True))
-    
-    for i in range(0, len(items), batch_size):
-        yield items[i:i + batch_size]
+    iterator = container.query_items(query=query, parameters=parameters, max_item_count=batch_size)
 
-def process_batch(items, blob_container_client, cosmos_container):
+    chunk = []
+    async for item in iterator:
+        chunk.append(item)
+        if len(chunk) >= batch_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def process_batch(items, blob_container_client, cosmos_container, index_container):
     """
-    Process a batch of items for archival.
+    Process a batch of items for archival. The batch is split by id-hash
+    bucket and coalesced into one archive pack blob per (date, bucket),
+    uploaded concurrently; index entries are written concurrently, and
+    only fully indexed records are deleted from Cosmos DB.
     """
-    archived_count = 0
     failed_count = 0
-    
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_OPERATIONS)
+
+    # One timestamp for the whole batch; per-record archive metadata does
+    # not need to differ by microseconds within a batch
+    archive_timestamp = datetime.utcnow().isoformat()
+
+    # Group by id-hash bucket so an id always lands in the same pack
+    # lineage for its archival date; batch reads over related ids then
+    # touch fewer packs
+    bucket_groups = {}
     for item in items:
-        try:
-            # Archive the record
-            if archive_record(item, blob_container_client):
-                # Delete from Cosmos DB after successful archival
-                cosmos_container.delete_item(item=item['id'], partition_key=item.get('partition_key', item['id']))
-                archived_count += 1
-                logging.info(f'Successfully archived and deleted record: {item["id"]}')
-            else:
-                failed_count += 1
-                logging.warning(f'Failed to archive record: {item["id"]}')
-                
-        except Exception as e:
+        bucket_groups.setdefault(pack_bucket(item['id']), []).append(item)
+
+    packs = []
+    for bucket, bucket_items in sorted(bucket_groups.items()):
+        blob_name, pack_buffer, offsets, failed_items = build_archive_pack(bucket_items, bucket)
+        failed_count += len(failed_items)
+
+        packed = [item for item in bucket_items if item['id'] in offsets]
+        if packed:
+            packs.append((blob_name, pack_buffer, offsets, packed))
+
+    if not packs:
+        return {'archived': 0, 'failed': failed_count}
+
+    upload_results = await asyncio.gather(
+        *(upload_pack(blob_container_client, blob_name, pack_buffer, len(packed),
+                      archive_timestamp, semaphore)
+          for blob_name, pack_buffer, offsets, packed in packs)
+    )
+
+    # Record each item's byte range in the archive index so retrieval can
+    # issue a ranged GET against its pack
+    packed_items = []
+    index_tasks = []
+    for (blob_name, pack_buffer, offsets, packed), uploaded in zip(packs, upload_results):
+        if not uploaded:
+            failed_count += len(packed)
+            continue
+        for item in packed:
+            packed_items.append(item)
+            index_tasks.append(write_index_entry(index_container, item['id'], blob_name,
+                                                 offsets[item['id']], archive_timestamp, semaphore))
+
+    if not packed_items:
+        return {'archived': 0, 'failed': failed_count}
+
+    index_results = await asyncio.gather(*index_tasks)
+
+    indexed_items = []
+    for item, indexed in zip(packed_items, index_results):
+        if indexed:
+            indexed_items.append(item)
+        else:
             failed_count += 1
-            logging.error(f'Error processing record {item.get("id", "unknown")}: {str(e)}')
-    
+            logging.warning(f'Failed to index archived record: {item["id"]}')
+
+    # Delete successfully archived records, batching deletes per partition key
+    delete_results = await delete_items_in_batches(cosmos_container, indexed_items, semaphore)
+    archived_count = delete_results['deleted']
+    failed_count += delete_results['failed']
+
     return {'archived': archived_count, 'failed': failed_count}
 
-def archive_record(record, blob_container_client):
+def pack_bucket(record_id):
     """
-    Archive a single record to blob storage with compression.
+    Map a record id to its archive pack bucket. crc32 keeps the mapping
+    stable across processes, unlike the salted builtin hash().
     """
-    try:
-        # Generate blob name based on record ID and date
-        blob_name = f"billing-records/{record['id']}.json.gz"
-        
-        # Compress the record data
-        record_json = json.dumps(record, default=str)
-        compressed_data = gzip.compress(record_json.encode('utf-8'))
-        
-        # Upload to blob storage
-        blob_container_client.upload_blob(
-            name=blob_name,
-            data=compressed_data,
-            overwrite=True,
-            metadata={
-                'record_id': record['id'],
-                'archived_date': datetime.utcnow().isoformat(),
-                'original_size': str(len(record_json)),
-                'compressed_size': str(len(compressed_data))
-            }
-        )
-        
-        return True
-        
-    except Exception as e:
-        logging.error(f'Error archiving record {record.get("id", "unknown")}: {str(e)}')
-        return False
+    return zlib.crc32(record_id.encode('utf-8')) % ARCHIVE_PACK_BUCKETS
+
+async def upload_pack(blob_container_client, blob_name, pack_buffer, record_count,
+                      archive_timestamp, semaphore):
+    """
+    Upload one pack blob with a single PUT. Returns True on success.
+    """
+    async with semaphore:
+        try:
+            pack_size = pack_buffer.tell()
+            pack_buffer.seek(0)
+            await blob_container_client.upload_blob(
+                name=blob_name,
+                data=pack_buffer,
+                length=pack_size,
+                overwrite=True,
+                metadata={
+                    'record_count': str(record_count),
+                    'archived_date': archive_timestamp,
+                    'compressed_size': str(pack_size)
+                }
+            )
+            return True
+        except Exception as e:
+            logging.error(f'Error uploading archive pack {blob_name}: {str(e)}')
+            return False
+
+def build_archive_pack(items, bucket):
+    """
+    Coalesce a group of records into a single pack blob keyed by archival
+    date and id-hash bucket. Each record is compressed as an independent
+    zstd frame appended to the pack, so a reader can fetch one record with
+    a ranged GET of (offset, length) and decompress it on its own. Returns
+    the pack blob name, the pack buffer, an id -> (offset, length) map and
+    the items that failed to serialize.
+    """
+    batch_id = uuid.uuid4().hex
+    blob_name = (f"billing-records/{datetime.utcnow().strftime('%Y/%m/%d')}/"
+                 f"bucket={bucket:02x}/{batch_id}.jsonl.zst")
+
+    buffer = io.BytesIO()
+    offsets = {}
+    failed_items = []
+
+    for item in items:
+        start = buffer.tell()
+        try:
+            record_bytes = orjson.dumps(item, default=str) + b'\n'
+            # Stream each record straight into the pack buffer as its own
+            # frame instead of materializing the compressed bytes first.
+            # size= embeds the content size in the frame header so readers
+            # can decompress a frame in one shot
+            with _COMPRESSOR.stream_writer(buffer, size=len(record_bytes), closefd=False) as writer:
+                writer.write(record_bytes)
+            offsets[item['id']] = (start, buffer.tell() - start)
+        except Exception as e:
+            # Drop any partially written frame so later offsets stay valid
+            buffer.seek(start)
+            buffer.truncate()
+            failed_items.append(item)
+            logging.error(f'Error packing record {item.get("id", "unknown")}: {str(e)}')
+
+    return blob_name, buffer, offsets, failed_items
+
+async def write_index_entry(index_container, record_id, blob_name, byte_range, archive_timestamp, semaphore):
+    """
+    Upsert the archive index document mapping a record id to its byte range
+    inside the pack blob.
+    """
+    async with semaphore:
+        try:
+            offset, length = byte_range
+            await index_container.upsert_item({
+                'id': record_id,
+                'blob_name': blob_name,
+                'offset': offset,
+                'length': length,
+                'archived_date': archive_timestamp
+            })
+            return True
+
+        except Exception as e:
+            logging.error(f'Error writing archive index for record {record_id}: {str(e)}')
+            return False
+
+async def delete_items_in_batches(cosmos_container, items, semaphore):
+    """
+    Delete items from Cosmos DB, coalescing deletes that share a partition
+    key into transactional batches (max 100 operations per batch) so a
+    batch costs one round-trip instead of one per record. Partition groups
+    are deleted concurrently under the shared semaphore.
+    """
+    # Group items by partition key (transactional batches are per-partition)
+    by_partition_key = {}
+    for item in items:
+        partition_key = item.get('partition_key', item['id'])
+        by_partition_key.setdefault(partition_key, []).append(item)
+
+    results = await asyncio.gather(
+        *(delete_partition_group(cosmos_container, partition_key, group, semaphore)
+          for partition_key, group in by_partition_key.items())
+    )
+
+    deleted_count = sum(r['deleted'] for r in results)
+    failed_count = sum(r['failed'] for r in results)
+
+    return {'deleted': deleted_count, 'failed': failed_count}
+
+async def delete_partition_group(cosmos_container, partition_key, group, semaphore):
+    """
+    Delete all items that share a partition key, using a transactional
+    batch when the group has more than one item.
+    """
+    async with semaphore:
+        try:
+            if len(group) == 1:
+                # Single item - a point delete is cheaper than a batch
+                await cosmos_container.delete_item(item=group[0]['id'], partition_key=partition_key)
+                logging.info(f'Successfully archived and deleted record: {group[0]["id"]}')
+            else:
+                # Cosmos allows up to 100 operations per transactional batch
+                for i in range(0, len(group), 100):
+                    chunk = group[i:i + 100]
+                    operations = [('delete', (item['id'],)) for item in chunk]
+                    await cosmos_container.execute_item_batch(
+                        batch_operations=operations,
+                        partition_key=partition_key
+                    )
+                    logging.info(f'Batch-deleted {len(chunk)} archived records for partition {partition_key}')
+
+            return {'deleted': len(group), 'failed': 0}
+
+        except Exception as e:
+            logging.error(f'Error deleting archived records for partition {partition_key}: {str(e)}')
+            return {'deleted': 0, 'failed': len(group)}
 
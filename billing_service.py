@@ -4,14 +4,31 @@ to appropriate storage (Cosmos DB for hot data, Blob Storage for archived data).
 """
 
 import azure.cosmos.cosmos_client as cosmos_client
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
 from azure.storage.blob import BlobServiceClient
-import json
 import logging
+import orjson
 import os
 import gzip
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+import zlib
+import threading
+import time
+import uuid
+from cachetools import TTLCache
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import zstandard as zstd
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify, Response
 import requests
+from requests.adapters import HTTPAdapter
+
+# Shared session so calls to the retrieval function reuse pooled
+# connections instead of opening a new one per request
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+SESSION.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
 
 # Configuration
 COSMOS_ENDPOINT = os.environ.get('COSMOS_ENDPOINT')
@@ -22,14 +39,91 @@ COSMOS_CONTAINER_NAME = os.environ.get('COSMOS_CONTAINER_NAME', 'records')
 BLOB_CONNECTION_STRING = os.environ.get('BLOB_CONNECTION_STRING')
 BLOB_CONTAINER_NAME = os.environ.get('BLOB_CONTAINER_NAME', 'archived-billing-records')
 
+ARCHIVE_INDEX_CONTAINER_NAME = os.environ.get('ARCHIVE_INDEX_CONTAINER_NAME', 'archive-index')
+
 RETRIEVAL_FUNCTION_URL = os.environ.get('RETRIEVAL_FUNCTION_URL')
 
+RECORD_CACHE_MAX_SIZE = int(os.environ.get('RECORD_CACHE_MAX_SIZE', '10000'))
+RECORD_CACHE_TTL_SECONDS = int(os.environ.get('RECORD_CACHE_TTL_SECONDS', '60'))
+
+ARCHIVE_PROMOTION_THRESHOLD = int(os.environ.get('ARCHIVE_PROMOTION_THRESHOLD', '5'))
+ARCHIVE_PROMOTION_DECAY_SECONDS = int(os.environ.get('ARCHIVE_PROMOTION_DECAY_SECONDS', '3600'))
+
 app = Flask(__name__)
 
+# Bounded TTL cache so repeated reads of hot records skip Cosmos and blob
+# storage entirely
+_record_cache = TTLCache(maxsize=RECORD_CACHE_MAX_SIZE, ttl=RECORD_CACHE_TTL_SECONDS)
+_record_cache_lock = threading.RLock()
+
+def get_cached_record(record_id):
+    # Hand out a copy so callers that mutate the record (e.g. updates)
+    # cannot change the cached entry behind the cache's back
+    with _record_cache_lock:
+        cached = _record_cache.get(record_id)
+    return dict(cached) if cached is not None else None
+
+def cache_record(record_id, record):
+    with _record_cache_lock:
+        _record_cache[record_id] = dict(record)
+
+def invalidate_cached_record(record_id):
+    with _record_cache_lock:
+        _record_cache.pop(record_id, None)
+
+# Access frequency of archived records, halved every decay period so the
+# counts behave like an exponential moving average of recent hotness
+_archive_access_counts = Counter()
+_archive_access_lock = threading.Lock()
+_archive_last_decay = time.monotonic()
+
+def record_archive_access(record_id):
+    """
+    Count an archive read and report whether the record has become hot
+    enough to promote back into Cosmos DB.
+    """
+    global _archive_last_decay
+
+    with _archive_access_lock:
+        now = time.monotonic()
+        if now - _archive_last_decay >= ARCHIVE_PROMOTION_DECAY_SECONDS:
+            for key in list(_archive_access_counts):
+                halved = _archive_access_counts[key] // 2
+                if halved:
+                    _archive_access_counts[key] = halved
+                else:
+                    del _archive_access_counts[key]
+            _archive_last_decay = now
+
+        _archive_access_counts[record_id] += 1
+
+        if _archive_access_counts[record_id] >= ARCHIVE_PROMOTION_THRESHOLD:
+            del _archive_access_counts[record_id]
+            return True
+        return False
+
+def promote_archived_record(record):
+    """
+    Re-insert a hot archived record into Cosmos DB so subsequent reads are
+    point reads again. The record is flagged so the archival scan leaves
+    it in place.
+    """
+    try:
+        promoted = {k: v for k, v in record.items()
+                    if k not in ('_retrieved_from_archive', '_retrieval_timestamp')}
+        promoted['promoted_from_archive'] = True
+
+        container.upsert_item(body=promoted)
+        logging.info(f'Promoted hot archived record back to Cosmos DB: {promoted["id"]}')
+
+    except Exception as e:
+        logging.error(f'Error promoting archived record {record.get("id", "unknown")}: {str(e)}')
+
 # Initialize clients
 cosmos_client_instance = cosmos_client.CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
 database = cosmos_client_instance.get_database_client(COSMOS_DATABASE_NAME)
 container = database.get_container_client(COSMOS_CONTAINER_NAME)
+archive_index_container = database.get_container_client(ARCHIVE_INDEX_CONTAINER_NAME)
 
 blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
 blob_container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
@@ -45,9 +139,10 @@ def create_billing_record():
         if not record_data:
             return jsonify({"error": "Invalid JSON data"}), 400
         
-        # Add metadata
-        record_data['created_date'] = datetime.utcnow().isoformat()
-        record_data['updated_date'] = datetime.utcnow().isoformat()
+        # Add metadata (one timestamp per request)
+        created_timestamp = datetime.utcnow().isoformat()
+        record_data['created_date'] = created_timestamp
+        record_data['updated_date'] = created_timestamp
         
         # Ensure ID exists
         if 'id' not in record_data:
@@ -82,7 +177,7 @@ def get_billing_record(record_id):
         
         if RETRIEVAL_FUNCTION_URL:
             # Use Azure Function for retrieval
-            response = requests.get(f'{RETRIEVAL_FUNCTION_URL}?id={record_id}')
+            response = SESSION.get(f'{RETRIEVAL_FUNCTION_URL}?id={record_id}')
             if response.status_code == 200:
                 return jsonify(response.json()), 200
             elif response.status_code == 404:
@@ -124,7 +219,9 @@ def update_billing_record(record_id):
         existing_record['updated_date'] = datetime.utcnow().isoformat()
         
         updated_record = container.replace_item(item=existing_record, body=existing_record)
-        
+
+        invalidate_cached_record(record_id)
+
         logging.info(f'Updated billing record: {record_id}')
         
         return jsonify(updated_record), 200
@@ -147,7 +244,9 @@ def delete_billing_record(record_id):
         
         # Delete the record
         container.delete_item(item=record_id, partition_key=record_id)
-        
+
+        invalidate_cached_record(record_id)
+
         logging.info(f'Deleted billing record: {record_id}')
         
         return jsonify({"message": "Record deleted successfully"}), 200
@@ -165,23 +264,41 @@ def list_billing_records():
         # Get query parameters
         limit = int(request.args.get('limit', 100))
         offset = int(request.args.get('offset', 0))
-        
-        # Query Cosmos DB
-        query = "SELECT * FROM c ORDER BY c.created_date DESC"
-        items = list(container.query_items(query=query, enable_cross_partition_query=True))
-        
-        # Apply pagination
-        paginated_items = items[offset:offset + limit]
-        
-        result = {
-            "records": paginated_items,
-            "total": len(items),
-            "limit": limit,
-            "offset": offset
-        }
-        
-        return jsonify(result), 200
-        
+        continuation_token = request.args.get('continuation_token')
+
+        # Page server-side instead of materializing the whole container
+        query = "SELECT * FROM c ORDER BY c.created_date DESC OFFSET @offset LIMIT @limit"
+        parameters = [
+            {"name": "@offset", "value": offset},
+            {"name": "@limit", "value": limit}
+        ]
+
+        iterator = container.query_items(
+            query=query,
+            parameters=parameters,
+            enable_cross_partition_query=True,
+            max_item_count=limit
+        )
+
+        pager = iterator.by_page(continuation_token)
+        page = next(pager, None)
+
+        # Stream the page record by record instead of materializing the
+        # whole JSON payload before the first byte goes out
+        def generate():
+            yield b'{"records":['
+            first = True
+            if page is not None:
+                for item in page:
+                    prefix = b'' if first else b','
+                    first = False
+                    yield prefix + orjson.dumps(item, default=str)
+            yield (b'],"limit":' + orjson.dumps(limit) +
+                   b',"offset":' + orjson.dumps(offset) +
+                   b',"continuation_token":' + orjson.dumps(pager.continuation_token) + b'}')
+
+        return Response(generate(), mimetype='application/json')
+
     except Exception as e:
         logging.error(f'Error listing billing records: {str(e)}')
         return jsonify({"error": "Internal server error"}), 500
@@ -200,80 +317,183 @@ def batch_get_billing_records():
         record_ids = request_data['ids']
         if not isinstance(record_ids, list):
             return jsonify({"error": "Record IDs must be a list"}), 400
-        
-        results = {}
-        
-        for record_id in record_ids:
-            # Try Cosmos DB first
-            record = get_from_cosmos_db(record_id)
-            
-            if not record:
-                # Try archived storage
-                if RETRIEVAL_FUNCTION_URL:
-                    try:
-                        response = requests.get(f'{RETRIEVAL_FUNCTION_URL}?id={record_id}')
-                        if response.status_code == 200:
-                            record = response.json()
-                    except Exception:
-                        pass
-                else:
-                    record = get_from_blob_storage(record_id)
-            
-            if record:
-                results[record_id] = record
-            else:
-                results[record_id] = {"error": "Record not found"}
-        
+
+        # One bulk query returns all hot records instead of a read per id
+        results = query_records_by_ids(record_ids)
+
+        # Only the misses hit archived storage, fetched in parallel
+        missing_ids = [record_id for record_id in record_ids if record_id not in results]
+
+        if missing_ids:
+            with ThreadPoolExecutor(max_workers=min(16, len(missing_ids))) as executor:
+                futures = {
+                    executor.submit(get_archived_record, record_id): record_id
+                    for record_id in missing_ids
+                }
+                for future in as_completed(futures):
+                    record_id = futures[future]
+                    record = future.result()
+                    results[record_id] = record if record else {"error": "Record not found"}
+
         return jsonify(results), 200
-        
+
     except Exception as e:
         logging.error(f'Error in batch retrieval: {str(e)}')
         return jsonify({"error": "Internal server error"}), 500
 
-def get_from_cosmos_db(record_id):
+def query_records_by_ids(record_ids):
     """
-    Retrieve a record from Cosmos DB.
+    Fetch multiple records from Cosmos DB with parameterized IN queries
+    (chunks of 100 ids) instead of one point-read per id.
     """
-    try:
-        # Try to read the item directly
+    records = {}
+
+    for i in range(0, len(record_ids), 100):
+        chunk = record_ids[i:i + 100]
+        parameters = [{"name": f"@id{j}", "value": record_id} for j, record_id in enumerate(chunk)]
+        placeholders = ",".join(parameter["name"] for parameter in parameters)
+        query = f"SELECT * FROM c WHERE c.id IN ({placeholders})"
+
+        for item in container.query_items(query=query, parameters=parameters, enable_cross_partition_query=True):
+            records[item['id']] = item
+
+    return records
+
+def get_archived_record(record_id):
+    """
+    Fetch a single archived record, either through the retrieval function
+    or directly from blob storage.
+    """
+    if RETRIEVAL_FUNCTION_URL:
         try:
-            item = container.read_item(item=record_id, partition_key=record_id)
-            return item
+            response = SESSION.get(f'{RETRIEVAL_FUNCTION_URL}?id={record_id}')
+            if response.status_code == 200:
+                return response.json()
         except Exception:
-            # If direct read fails, try querying
-            query = f"SELECT * FROM c WHERE c.id = '{record_id}'"
-            items = list(container.query_items(query=query, enable_cross_partition_query=True))
-            return items[0] if items else None
-            
-    except Exception as e:
-        logging.error(f'Error retrieving from Cosmos DB: {str(e)}')
+            pass
+        return None
+
+    return get_from_blob_storage(record_id)
+
+def get_from_cosmos_db(record_id):
+    """
+    Retrieve a record from Cosmos DB with a point read. Records are
+    partitioned by id, so this costs ~1 RU and a single round-trip; a
+    missing record returns None and any other error propagates.
+    """
+    cached = get_cached_record(record_id)
+    if cached is not None:
+        return cached
+
+    try:
+        item = container.read_item(item=record_id, partition_key=record_id)
+    except CosmosResourceNotFoundError:
+        return None
+
+    cache_record(record_id, item)
+    return item
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def load_zstd_dictionary():
+    """
+    Load the optional shared zstd dictionary used by the archival writer.
+    """
+    dict_path = os.environ.get('ZSTD_DICT_PATH')
+    if dict_path and os.path.exists(dict_path):
+        with open(dict_path, 'rb') as f:
+            return zstd.ZstdCompressionDict(f.read())
+    return None
+
+_ZSTD_DICT = load_zstd_dictionary()
+
+def decompress_record_data(compressed_data):
+    """
+    Decompress an archived record, handling both current zstd frames and
+    legacy gzip blobs by sniffing the magic bytes.
+    """
+    if compressed_data[:4] == ZSTD_MAGIC:
+        # decompressobj does not require a content size in the frame
+        # header, which frames streamed into older packs omit
+        return zstd.ZstdDecompressor(dict_data=_ZSTD_DICT).decompressobj().decompress(compressed_data)
+    return gzip.decompress(compressed_data)
+
+def stream_decompress_blob(downloader):
+    """
+    Decompress a full-blob download incrementally, feeding each network
+    chunk straight into a decompressor instead of buffering the whole
+    compressed payload first. Peak memory is the decompressed size plus
+    one chunk rather than compressed plus decompressed.
+    """
+    decompressor = None
+    pieces = []
+    for chunk in downloader.chunks():
+        if decompressor is None:
+            if chunk[:4] == ZSTD_MAGIC:
+                decompressor = zstd.ZstdDecompressor(dict_data=_ZSTD_DICT).decompressobj()
+            else:
+                # 16 + MAX_WBITS tells zlib to expect a gzip header
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pieces.append(decompressor.decompress(chunk))
+    return b''.join(pieces)
+
+def get_archive_index_entry(record_id):
+    """
+    Look up the archive index entry mapping a record id to its byte range
+    inside an archive pack blob.
+    """
+    try:
+        return archive_index_container.read_item(item=record_id, partition_key=record_id)
+    except Exception:
         return None
 
 def get_from_blob_storage(record_id):
     """
-    Retrieve a record from Blob Storage.
+    Retrieve a record from Blob Storage. Records archived into coalesced
+    packs are fetched with a ranged GET of just their byte range; records
+    archived before the pack layout fall back to their per-record blob.
     """
+    cached = get_cached_record(record_id)
+    if cached is not None:
+        return cached
+
     try:
-        # Construct blob name
-        blob_name = f"billing-records/{record_id}.json.gz"
-        
-        # Download and decompress the blob
-        blob_client = blob_container_client.get_blob_client(blob_name)
-        
-        if not blob_client.exists():
-            return None
-        
-        # Download the compressed data
-        compressed_data = blob_client.download_blob().readall()
-        
-        # Decompress and parse JSON
-        decompressed_data = gzip.decompress(compressed_data)
-        record = json.loads(decompressed_data.decode('utf-8'))
+        index_entry = get_archive_index_entry(record_id)
+
+        if index_entry:
+            # Ranged read of the record's gzip member inside the pack
+            blob_client = blob_container_client.get_blob_client(index_entry['blob_name'])
+            compressed_data = blob_client.download_blob(
+                offset=index_entry['offset'],
+                length=index_entry['length']
+            ).readall()
+            decompressed_data = decompress_record_data(compressed_data)
+        else:
+            # Legacy layout: one blob per record, stream-decompressed so
+            # the compressed payload is never buffered whole
+            blob_name = f"billing-records/{record_id}.json.gz"
+            blob_client = blob_container_client.get_blob_client(blob_name)
+
+            # Download directly and let a 404 signal the miss - an
+            # upfront exists() check would cost an extra round-trip
+            try:
+                downloader = blob_client.download_blob()
+            except ResourceNotFoundError:
+                return None
+            decompressed_data = stream_decompress_blob(downloader)
+
+        record = orjson.loads(decompressed_data)
         
         # Add metadata about retrieval
         record['_retrieved_from_archive'] = True
-        record['_retrieval_timestamp'] = datetime.utcnow().isoformat()
-        
+        record['_retrieval_timestamp'] = datetime.now(timezone.utc).isoformat()
+
+        cache_record(record_id, record)
+
+        # Promote records that keep getting pulled out of the archive
+        if record_archive_access(record_id):
+            promote_archived_record(record)
+
         return record
         
     except Exception as e:
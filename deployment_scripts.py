@@ -2,298 +2,429 @@
 Deployment and Setup Scripts for Azure Billing Cost Optimization Solution.
 """
 
+import functools
 import json
 import os
-import subprocess
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.identity import DefaultAzureCredential
+from azure.mgmt.resource import ResourceManagementClient
+from azure.mgmt.cosmosdb import CosmosDBManagementClient
+from azure.mgmt.storage import StorageManagementClient
+from azure.mgmt.web import WebSiteManagementClient
+
+# Constant fragments of the ARM request bodies, factored out so the
+# resource shapes are reviewable in one place and each deploy call only
+# fills in the varying fields.
+COSMOS_CONSISTENCY_POLICY = {'default_consistency_level': 'Session'}
+
+# Minimal indexing: /id is covered implicitly by the partition key for
+# point reads; the single range index on /created_date serves the
+# archival sweep.
+RECORDS_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [
+        {"path": "/created_date/?"}
+    ],
+    "excludedPaths": [
+        {"path": "/*"}
+    ]
+}
+
+# The archive index is only ever point read by record id, which the
+# partition key covers implicitly, so nothing else needs indexing.
+ARCHIVE_INDEX_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [],
+    "excludedPaths": [
+        {"path": "/*"}
+    ]
+}
+
+STORAGE_ACCOUNT_SKU = {'name': 'Standard_LRS'}
+STORAGE_ACCOUNT_KIND = 'StorageV2'
+
+FUNCTION_APP_BASE_SETTINGS = (
+    {'name': 'FUNCTIONS_EXTENSION_VERSION', 'value': '~4'},
+    {'name': 'FUNCTIONS_WORKER_RUNTIME', 'value': 'python'}
+)
+FUNCTION_APP_RUNTIME = 'Python|3.11'
+
+# Sentinel returned by the begin_* helpers when a cheap existence probe
+# shows the resource is already provisioned, so re-runs skip the
+# multi-minute ARM create instead of re-issuing it.
+RESOURCE_EXISTS = 'exists'
+
+@functools.lru_cache(maxsize=1)
+def get_credential():
+    """
+    Shared DefaultAzureCredential for the whole process. Tokens acquired
+    for one management client are reused by the others instead of each
+    manager instance re-running the credential chain.
+    """
+    return DefaultAzureCredential()
 
 class AzureDeploymentManager:
     """
     Manages deployment of the billing cost optimization solution to Azure.
+
+    Uses the Azure management SDK directly instead of shelling out to the
+    az CLI, so one authenticated credential is amortized across every ARM
+    call and there is no per-step process startup cost.
     """
-    
+
     def __init__(self, config):
         self.config = config
         self.resource_group = config.get('resource_group')
         self.location = config.get('location', 'East US')
         self.subscription_id = config.get('subscription_id')
-    
+
+        self.credential = get_credential()
+        self.resource_client = ResourceManagementClient(self.credential, self.subscription_id)
+        self.cosmos_client = CosmosDBManagementClient(self.credential, self.subscription_id)
+        self.storage_client = StorageManagementClient(self.credential, self.subscription_id)
+        self.web_client = WebSiteManagementClient(self.credential, self.subscription_id)
+
     def create_resource_group(self):
         """
         Create Azure resource group if it doesn't exist.
         """
-        cmd = [
-            'az', 'group', 'create',
-            '--name', self.resource_group,
-            '--location', self.location
-        ]
-        
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            self.resource_client.resource_groups.create_or_update(
+                self.resource_group,
+                {'location': self.location}
+            )
             logging.info(f"Resource group {self.resource_group} created successfully")
             return True
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create resource group: {e.stderr}")
+        except Exception as e:
+            logging.error(f"Failed to create resource group: {str(e)}")
             return False
-    
-    def deploy_cosmos_db(self):
+
+    def begin_cosmos_account(self, cosmos_config):
         """
-        Deploy Cosmos DB with optimized settings.
+        Start creating the Cosmos DB account. Returns the LRO poller so
+        deploy_solution can overlap it with the other account creations,
+        or RESOURCE_EXISTS when the account is already provisioned.
         """
-        cosmos_config = {
-            "account_name": f"{self.config['project_name']}-cosmos",
-            "database_name": "billing",
-            "container_name": "records",
-            "throughput": 400,  # Minimum autoscale
-            "max_throughput": 4000
-        }
-        
-        # Create Cosmos DB account
-        cmd = [
-            'az', 'cosmosdb', 'create',
-            '--name', cosmos_config['account_name'],
-            '--resource-group', self.resource_group,
-            '--locations', f"regionName={self.location}",
-            '--default-consistency-level', 'Session',
-            '--enable-automatic-failover', 'true'
-        ]
-        
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
-            logging.info(f"Cosmos DB account {cosmos_config['account_name']} created")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create Cosmos DB: {e.stderr}")
-            return False
-        
-        # Create database
-        cmd = [
-            'az', 'cosmosdb', 'sql', 'database', 'create',
-            '--account-name', cosmos_config['account_name'],
-            '--resource-group', self.resource_group,
-            '--name', cosmos_config['database_name']
-        ]
-        
+            self.cosmos_client.database_accounts.get(
+                self.resource_group, cosmos_config['account_name']
+            )
+            logging.info(f"Cosmos DB account {cosmos_config['account_name']} already exists, skipping create")
+            return RESOURCE_EXISTS
+        except ResourceNotFoundError:
+            pass
+
+        try:
+            return self.cosmos_client.database_accounts.begin_create_or_update(
+                self.resource_group,
+                cosmos_config['account_name'],
+                {
+                    'location': self.location,
+                    'locations': [{'location_name': self.location, 'failover_priority': 0}],
+                    'database_account_offer_type': 'Standard',
+                    'consistency_policy': COSMOS_CONSISTENCY_POLICY,
+                    'enable_automatic_failover': True
+                }
+            )
+        except Exception as e:
+            logging.error(f"Failed to start Cosmos DB account creation: {str(e)}")
+            return None
+
+    def create_cosmos_database_and_container(self, cosmos_config):
+        """
+        Create the billing database and records container with optimized
+        indexing. Depends on the Cosmos DB account existing.
+        """
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
+            self.cosmos_client.sql_resources.begin_create_update_sql_database(
+                self.resource_group,
+                cosmos_config['account_name'],
+                cosmos_config['database_name'],
+                {'resource': {'id': cosmos_config['database_name']}, 'options': {}}
+            ).result()
             logging.info(f"Database {cosmos_config['database_name']} created")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create database: {e.stderr}")
+        except Exception as e:
+            logging.error(f"Failed to create database: {str(e)}")
             return False
-        
-        # Create container with optimized indexing
-        indexing_policy = {
-            "indexingMode": "consistent",
-            "automatic": True,
-            "includedPaths": [
-                {"path": "/id/?"},
-                {"path": "/created_date/?"}
-            ],
-            "excludedPaths": [
-                {"path": "/*"}
-            ]
-        }
-        
-        cmd = [
-            'az', 'cosmosdb', 'sql', 'container', 'create',
-            '--account-name', cosmos_config['account_name'],
-            '--resource-group', self.resource_group,
-            '--database-name', cosmos_config['database_name'],
-            '--name', cosmos_config['container_name'],
-            '--partition-key-path', '/id',
-            '--throughput', str(cosmos_config['throughput']),
-            '--idx', json.dumps(indexing_policy)
-        ]
-        
+
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
+            self.cosmos_client.sql_resources.begin_create_update_sql_container(
+                self.resource_group,
+                cosmos_config['account_name'],
+                cosmos_config['database_name'],
+                cosmos_config['container_name'],
+                {
+                    'resource': {
+                        'id': cosmos_config['container_name'],
+                        'partition_key': {'paths': ['/id'], 'kind': 'Hash'},
+                        'indexing_policy': RECORDS_INDEXING_POLICY
+                    },
+                    'options': {'throughput': cosmos_config['throughput']}
+                }
+            ).result()
             logging.info(f"Container {cosmos_config['container_name']} created")
-            return cosmos_config
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create container: {e.stderr}")
+        except Exception as e:
+            logging.error(f"Failed to create container: {str(e)}")
+            return False
+
+        # The archive index container maps record ids to pack byte ranges;
+        # without it every index upsert 404s and archival never deletes
+        try:
+            self.cosmos_client.sql_resources.begin_create_update_sql_container(
+                self.resource_group,
+                cosmos_config['account_name'],
+                cosmos_config['database_name'],
+                cosmos_config['index_container_name'],
+                {
+                    'resource': {
+                        'id': cosmos_config['index_container_name'],
+                        'partition_key': {'paths': ['/id'], 'kind': 'Hash'},
+                        'indexing_policy': ARCHIVE_INDEX_INDEXING_POLICY
+                    },
+                    'options': {'throughput': cosmos_config['index_throughput']}
+                }
+            ).result()
+            logging.info(f"Container {cosmos_config['index_container_name']} created")
+            return True
+        except Exception as e:
+            logging.error(f"Failed to create archive index container: {str(e)}")
             return False
-    
-    def deploy_storage_account(self):
+
+    def begin_storage_account(self, account_name, access_tier=None):
         """
-        Deploy storage account with lifecycle management.
+        Start creating a storage account. Returns the LRO poller so
+        deploy_solution can overlap it with the other account creations,
+        or RESOURCE_EXISTS when the account is already provisioned.
         """
-        storage_config = {
-            "account_name": f"{self.config['project_name']}storage",
-            "container_name": "archived-billing-records"
+        try:
+            self.storage_client.storage_accounts.get_properties(
+                self.resource_group, account_name
+            )
+            logging.info(f"Storage account {account_name} already exists, skipping create")
+            return RESOURCE_EXISTS
+        except ResourceNotFoundError:
+            pass
+
+        parameters = {
+            'location': self.location,
+            'sku': STORAGE_ACCOUNT_SKU,
+            'kind': STORAGE_ACCOUNT_KIND
         }
-        
-        # Create storage account
-        cmd = [
-            'az', 'storage', 'account', 'create',
-            '--name', storage_config['account_name'],
-            '--resource-group', self.resource_group,
-            '--location', self.location,
-            '--sku', 'Standard_LRS',
-            '--kind', 'StorageV2',
-            '--access-tier', 'Cool'
-        ]
-        
+        if access_tier:
+            parameters['access_tier'] = access_tier
+
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
-            logging.info(f"Storage account {storage_config['account_name']} created")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create storage account: {e.stderr}")
-            return False
-        
-        # Create blob container
-        cmd = [
-            'az', 'storage', 'container', 'create',
-            '--name', storage_config['container_name'],
-            '--account-name', storage_config['account_name'],
-            '--resource-group', self.resource_group
-        ]
-        
+            return self.storage_client.storage_accounts.begin_create(
+                self.resource_group,
+                account_name,
+                parameters
+            )
+        except Exception as e:
+            logging.error(f"Failed to start storage account creation for {account_name}: {str(e)}")
+            return None
+
+    def create_blob_container(self, storage_config):
+        """
+        Create the archive blob container. Depends on the storage account
+        existing.
+        """
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
+            self.storage_client.blob_containers.create(
+                self.resource_group,
+                storage_config['account_name'],
+                storage_config['container_name'],
+                {}
+            )
             logging.info(f"Blob container {storage_config['container_name']} created")
-            return storage_config
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create blob container: {e.stderr}")
+            return True
+        except Exception as e:
+            logging.error(f"Failed to create blob container: {str(e)}")
             return False
-    
-    def deploy_function_app(self):
+
+    def get_storage_connection_string(self, account_name):
         """
-        Deploy Azure Function App for archival and retrieval.
+        Build a connection string for a storage account from its primary key.
         """
-        function_config = {
-            "app_name": f"{self.config['project_name']}-functions",
-            "storage_account": f"{self.config['project_name']}funcstorage"
-        }
-        
-        # Create storage account for function app
-        cmd = [
-            'az', 'storage', 'account', 'create',
-            '--name', function_config['storage_account'],
-            '--resource-group', self.resource_group,
-            '--location', self.location,
-            '--sku', 'Standard_LRS'
-        ]
-        
+        keys = self.storage_client.storage_accounts.list_keys(self.resource_group, account_name)
+        primary_key = keys.keys[0].value
+        return (
+            f"DefaultEndpointsProtocol=https;AccountName={account_name};"
+            f"AccountKey={primary_key};EndpointSuffix=core.windows.net"
+        )
+
+    def create_function_app(self, function_config):
+        """
+        Create the Azure Function App on the consumption plan. Depends on
+        its storage account existing.
+        """
+        # web_apps.get returns None rather than raising on a missing app
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
-            logging.info(f"Function storage account created")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create function storage: {e.stderr}")
-            return False
-        
-        # Create function app
-        cmd = [
-            'az', 'functionapp', 'create',
-            '--name', function_config['app_name'],
-            '--resource-group', self.resource_group,
-            '--storage-account', function_config['storage_account'],
-            '--consumption-plan-location', self.location,
-            '--runtime', 'python',
-            '--runtime-version', '3.11',
-            '--functions-version', '4'
-        ]
-        
+            existing_app = self.web_client.web_apps.get(self.resource_group, function_config['app_name'])
+        except ResourceNotFoundError:
+            existing_app = None
+        if existing_app:
+            logging.info(f"Function app {function_config['app_name']} already exists, skipping create")
+            return True
+
         try:
-            subprocess.run(cmd, capture_output=True, text=True, check=True)
+            storage_connection_string = self.get_storage_connection_string(
+                function_config['storage_account']
+            )
+
+            self.web_client.web_apps.begin_create_or_update(
+                self.resource_group,
+                function_config['app_name'],
+                {
+                    'location': self.location,
+                    'kind': 'functionapp,linux',
+                    'reserved': True,
+                    'site_config': {
+                        'linux_fx_version': FUNCTION_APP_RUNTIME,
+                        'app_settings': [
+                            *FUNCTION_APP_BASE_SETTINGS,
+                            {'name': 'AzureWebJobsStorage', 'value': storage_connection_string}
+                        ]
+                    }
+                }
+            ).result()
             logging.info(f"Function app {function_config['app_name']} created")
-            return function_config
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to create function app: {e.stderr}")
+            return True
+        except Exception as e:
+            logging.error(f"Failed to create function app: {str(e)}")
             return False
-    
+
     def configure_app_settings(self, cosmos_config, storage_config, function_config):
         """
         Configure application settings for the function app.
         """
-        # Get Cosmos DB connection string
-        cmd = [
-            'az', 'cosmosdb', 'keys', 'list',
-            '--name', cosmos_config['account_name'],
-            '--resource-group', self.resource_group,
-            '--type', 'keys'
-        ]
-        
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            cosmos_keys = json.loads(result.stdout)
-            cosmos_key = cosmos_keys['primaryMasterKey']
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to get Cosmos DB keys: {e.stderr}")
+            cosmos_keys = self.cosmos_client.database_accounts.list_keys(
+                self.resource_group,
+                cosmos_config['account_name']
+            )
+            cosmos_key = cosmos_keys.primary_master_key
+        except Exception as e:
+            logging.error(f"Failed to get Cosmos DB keys: {str(e)}")
             return False
-        
-        # Get storage connection string
-        cmd = [
-            'az', 'storage', 'account', 'show-connection-string',
-            '--name', storage_config['account_name'],
-            '--resource-group', self.resource_group
-        ]
-        
+
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            storage_conn = json.loads(result.stdout)
-            storage_connection_string = storage_conn['connectionString']
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to get storage connection string: {e.stderr}")
+            storage_connection_string = self.get_storage_connection_string(
+                storage_config['account_name']
+            )
+        except Exception as e:
+            logging.error(f"Failed to get storage connection string: {str(e)}")
             return False
-        
-        # Set application settings
-        settings = [
-            f"COSMOS_ENDPOINT=https://{cosmos_config['account_name']}.documents.azure.com:443/",
-            f"COSMOS_KEY={cosmos_key}",
-            f"COSMOS_DATABASE_NAME={cosmos_config['database_name']}",
-            f"COSMOS_CONTAINER_NAME={cosmos_config['container_name']}",
-            f"BLOB_CONNECTION_STRING={storage_connection_string}",
-            f"BLOB_CONTAINER_NAME={storage_config['container_name']}"
-        ]
-        
-        for setting in settings:
-            cmd = [
-                'az', 'functionapp', 'config', 'appsettings', 'set',
-                '--name', function_config['app_name'],
-                '--resource-group', self.resource_group,
-                '--settings', setting
-            ]
-            
-            try:
-                subprocess.run(cmd, capture_output=True, text=True, check=True)
-            except subprocess.CalledProcessError as e:
-                logging.error(f"Failed to set app setting {setting}: {e.stderr}")
-                return False
-        
+
+        settings = {
+            'COSMOS_ENDPOINT': f"https://{cosmos_config['account_name']}.documents.azure.com:443/",
+            'COSMOS_KEY': cosmos_key,
+            'COSMOS_DATABASE_NAME': cosmos_config['database_name'],
+            'COSMOS_CONTAINER_NAME': cosmos_config['container_name'],
+            'BLOB_CONNECTION_STRING': storage_connection_string,
+            'BLOB_CONTAINER_NAME': storage_config['container_name']
+        }
+
+        # update_application_settings replaces the whole collection, so
+        # merge with the current settings to keep the runtime and storage
+        # bindings create_function_app established
+        try:
+            current_settings = self.web_client.web_apps.list_application_settings(
+                self.resource_group,
+                function_config['app_name']
+            )
+            merged_settings = dict(current_settings.properties or {})
+        except Exception as e:
+            logging.error(f"Failed to read current app settings: {str(e)}")
+            return False
+
+        merged_settings.update(settings)
+
+        # One ARM call applies every setting
+        try:
+            self.web_client.web_apps.update_application_settings(
+                self.resource_group,
+                function_config['app_name'],
+                {'properties': merged_settings}
+            )
+        except Exception as e:
+            logging.error(f"Failed to set app settings: {str(e)}")
+            return False
+
         logging.info("Application settings configured successfully")
         return True
-    
+
     def deploy_solution(self):
         """
-        Deploy the complete solution.
+        Deploy the complete solution. The three independent account
+        creations are started together and their pollers awaited, so the
+        ARM operations provision concurrently; dependent resources are
+        created once their accounts exist.
         """
         logging.info("Starting deployment of billing cost optimization solution")
-        
+
         # Create resource group
         if not self.create_resource_group():
             return False
-        
-        # Deploy Cosmos DB
-        cosmos_config = self.deploy_cosmos_db()
-        if not cosmos_config:
+
+        cosmos_config = {
+            "account_name": f"{self.config['project_name']}-cosmos",
+            "database_name": "billing",
+            "container_name": "records",
+            "index_container_name": "archive-index",
+            "throughput": 400,  # Minimum autoscale
+            "index_throughput": 400,
+            "max_throughput": 4000
+        }
+        storage_config = {
+            "account_name": f"{self.config['project_name']}storage",
+            "container_name": "archived-billing-records"
+        }
+        function_config = {
+            "app_name": f"{self.config['project_name']}-functions",
+            "storage_account": f"{self.config['project_name']}funcstorage"
+        }
+
+        # Kick off the three independent account creations before waiting
+        # on any of them - ARM provisions them concurrently
+        pollers = [
+            self.begin_cosmos_account(cosmos_config),
+            self.begin_storage_account(storage_config['account_name'], access_tier='Cool'),
+            self.begin_storage_account(function_config['storage_account'])
+        ]
+        if not all(pollers):
+            return False
+
+        try:
+            for poller in pollers:
+                if poller is not RESOURCE_EXISTS:
+                    poller.result()
+        except Exception as e:
+            logging.error(f"Account provisioning failed: {str(e)}")
+            return False
+
+        logging.info("Cosmos DB and storage accounts provisioned")
+
+        # Dependent resources
+        if not self.create_cosmos_database_and_container(cosmos_config):
             return False
-        
-        # Deploy storage account
-        storage_config = self.deploy_storage_account()
-        if not storage_config:
+
+        if not self.create_blob_container(storage_config):
             return False
-        
-        # Deploy function app
-        function_config = self.deploy_function_app()
-        if not function_config:
+
+        if not self.create_function_app(function_config):
             return False
-        
+
         # Configure app settings
         if not self.configure_app_settings(cosmos_config, storage_config, function_config):
             return False
-        
+
         deployment_info = {
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
             "resource_group": self.resource_group,
             "cosmos_db": cosmos_config,
             "storage": storage_config,
@@ -303,11 +434,11 @@ class AzureDeploymentManager:
                 "function_app_url": f"https://{function_config['app_name']}.azurewebsites.net"
             }
         }
-        
+
         # Save deployment info
         with open('deployment_info.json', 'w') as f:
             json.dump(deployment_info, f, indent=2)
-        
+
         logging.info("Deployment completed successfully")
         return deployment_info
 
@@ -321,12 +452,21 @@ def create_deployment_config():
         "location": "East US",
         "subscription_id": "your-subscription-id-here"
     }
-    
+
     with open('deployment_config.json', 'w') as f:
         json.dump(config, f, indent=2)
-    
+
     return config
 
+@functools.lru_cache(maxsize=1)
+def load_config():
+    """
+    Load and cache the deployment configuration. Repeated calls in one
+    process reuse the parsed dict instead of re-reading the file.
+    """
+    with open('deployment_config.json', 'r') as f:
+        return json.load(f)
+
 def main():
     """
     Main deployment function.
@@ -336,15 +476,13 @@ def main():
         config = create_deployment_config()
         print("Created deployment_config.json. Please update with your Azure subscription details.")
         return
-    
-    # Load configuration
-    with open('deployment_config.json', 'r') as f:
-        config = json.load(f)
-    
+
+    config = load_config()
+
     # Deploy solution
     deployment_manager = AzureDeploymentManager(config)
     result = deployment_manager.deploy_solution()
-    
+
     if result:
         print("Deployment completed successfully!")
         print(f"Deployment info saved to deployment_info.json")
@@ -353,4 +491,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
@@ -14,26 +14,26 @@ app = func.FunctionApp()
 
 @app.timer_trigger(schedule="0 0 2 * * *", arg_name="mytimer", run_on_startup=False,
               use_monitor=False) 
-def archival_timer(mytimer: func.TimerRequest) -> None:
+async def archival_timer(mytimer: func.TimerRequest) -> None:
     """
     Timer trigger for archival function - runs daily at 2 AM UTC.
     """
     if mytimer.past_due:
         logging.info('The timer is past due!')
-    
-    archival_main(mytimer)
+
+    await archival_main(mytimer)
 
 @app.route(route="retrieve", methods=["GET", "POST"])
-def retrieve_record(req: func.HttpRequest) -> func.HttpResponse:
+async def retrieve_record(req: func.HttpRequest) -> func.HttpResponse:
     """
     HTTP trigger for retrieving individual billing records.
     """
-    return retrieval_main(req)
+    return await retrieval_main(req)
 
 @app.route(route="retrieve/batch", methods=["POST"])
-def retrieve_batch_records(req: func.HttpRequest) -> func.HttpResponse:
+async def retrieve_batch_records(req: func.HttpRequest) -> func.HttpResponse:
     """
     HTTP trigger for batch retrieval of billing records.
     """
-    return batch_retrieve(req)
+    return await batch_retrieve(req)
 
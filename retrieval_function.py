@@ -3,14 +3,20 @@ Azure Function for retrieving archived billing records from Blob Storage.
 This function is triggered by HTTP requests when archived data is needed.
 """
 
+import asyncio
 import azure.functions as func
-import azure.cosmos.cosmos_client as cosmos_client
-from azure.storage.blob import BlobServiceClient
-import json
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.storage.blob.aio import BlobServiceClient
+import orjson
 import logging
 import os
 import gzip
-from datetime import datetime
+import zlib
+import zstandard as zstd
+from cachetools import LRUCache
+from datetime import datetime, timezone
 
 # Configuration
 COSMOS_ENDPOINT = os.environ.get('COSMOS_ENDPOINT')
@@ -21,12 +27,87 @@ COSMOS_CONTAINER_NAME = os.environ.get('COSMOS_CONTAINER_NAME', 'records')
 BLOB_CONNECTION_STRING = os.environ.get('BLOB_CONNECTION_STRING')
 BLOB_CONTAINER_NAME = os.environ.get('BLOB_CONTAINER_NAME', 'archived-billing-records')
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+ARCHIVE_INDEX_CONTAINER_NAME = os.environ.get('ARCHIVE_INDEX_CONTAINER_NAME', 'archive-index')
+
+ARCHIVE_BYTES_CACHE_MAX_SIZE = int(os.environ.get('ARCHIVE_BYTES_CACHE_MAX_SIZE', '2048'))
+
+# Archived records are immutable once written, so their payloads can be
+# cached for the lifetime of the worker. A hit skips the index lookup, the
+# blob GET and the decompression. The worker's single event loop serializes
+# access, so no lock is needed.
+_archived_bytes_cache = LRUCache(maxsize=ARCHIVE_BYTES_CACHE_MAX_SIZE)
+
+# Clients are created lazily and shared across invocations so the Functions
+# host reuses the SDK connection pools instead of paying a TLS handshake and
+# account metadata fetch per request (or per id in the batch path). The
+# async SDKs free the worker's event loop during every network wait.
+_clients_lock = asyncio.Lock()
+_records_container = None
+_index_container = None
+_blob_container = None
+
+async def get_cosmos_containers():
+    """
+    Return the shared records and archive-index container clients,
+    creating them on first use.
+    """
+    global _records_container, _index_container
+
+    if _records_container is None:
+        async with _clients_lock:
+            if _records_container is None:
+                cosmos_client_instance = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+                database = cosmos_client_instance.get_database_client(COSMOS_DATABASE_NAME)
+                _index_container = database.get_container_client(ARCHIVE_INDEX_CONTAINER_NAME)
+                _records_container = database.get_container_client(COSMOS_CONTAINER_NAME)
+
+    return _records_container, _index_container
+
+async def get_blob_container():
+    """
+    Return the shared blob container client, creating it on first use.
+    """
+    global _blob_container
+
+    if _blob_container is None:
+        async with _clients_lock:
+            if _blob_container is None:
+                blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
+                _blob_container = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
+
+    return _blob_container
+
+# Bodies below this size are not worth the compression round-trip
+GZIP_RESPONSE_MIN_BYTES = 1024
+
+def json_response(req, payload, status_code=200):
+    """
+    Build a JSON HttpResponse, gzip-compressing large bodies when the
+    client advertises gzip support. compresslevel=1 keeps the CPU cost
+    minimal while still shrinking JSON payloads several-fold.
+    """
+    body = orjson.dumps(payload, default=str)
+
+    if len(body) >= GZIP_RESPONSE_MIN_BYTES and 'gzip' in req.headers.get('Accept-Encoding', ''):
+        return func.HttpResponse(
+            gzip.compress(body, compresslevel=1),
+            status_code=status_code,
+            mimetype="application/json",
+            headers={"Content-Encoding": "gzip"}
+        )
+
+    return func.HttpResponse(
+        body,
+        status_code=status_code,
+        mimetype="application/json"
+    )
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     """
     Main function to handle HTTP requests for retrieving billing records.
     """
     logging.info('Processing billing record retrieval request')
-    
+
     try:
         # Get record ID from request
         record_id = req.params.get('id')
@@ -36,159 +117,300 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 record_id = req_body.get('id') if req_body else None
             except ValueError:
                 pass
-        
+
         if not record_id:
-            return func.HttpResponse(
-                json.dumps({"error": "Record ID is required"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
+            return json_response(req, {"error": "Record ID is required"}, status_code=400)
+
         # First, try to get the record from Cosmos DB (hot data)
-        record = get_from_cosmos_db(record_id)
-        
+        record = await get_from_cosmos_db(record_id)
+
         if record:
             logging.info(f'Record {record_id} found in Cosmos DB')
-            return func.HttpResponse(
-                json.dumps(record, default=str),
-                status_code=200,
-                mimetype="application/json"
-            )
-        
+            return json_response(req, record)
+
         # If not found in Cosmos DB, try archived storage
         logging.info(f'Record {record_id} not found in Cosmos DB, checking archived storage')
-        archived_record = get_from_blob_storage(record_id)
-        
+        archived_record = await get_from_blob_storage(record_id)
+
         if archived_record:
             logging.info(f'Record {record_id} found in archived storage')
-            return func.HttpResponse(
-                json.dumps(archived_record, default=str),
-                status_code=200,
-                mimetype="application/json"
-            )
-        
+            return json_response(req, archived_record)
+
         # Record not found anywhere
         logging.warning(f'Record {record_id} not found in either Cosmos DB or archived storage')
-        return func.HttpResponse(
-            json.dumps({"error": "Record not found"}),
-            status_code=404,
-            mimetype="application/json"
-        )
-        
+        return json_response(req, {"error": "Record not found"}, status_code=404)
+
     except Exception as e:
         logging.error(f'Error retrieving record: {str(e)}')
-        return func.HttpResponse(
-            json.dumps({"error": "Internal server error"}),
-            status_code=500,
-            mimetype="application/json"
-        )
+        return json_response(req, {"error": "Internal server error"}, status_code=500)
 
-def get_from_cosmos_db(record_id):
+async def get_from_cosmos_db(record_id):
     """
-    Retrieve a record from Cosmos DB.
+    Retrieve a record from Cosmos DB with a point read. Records are
+    partitioned by id, so this costs ~1 RU and a single round-trip; a
+    missing record returns None and any other error propagates.
     """
+    container, _ = await get_cosmos_containers()
+
     try:
-        cosmos_client_instance = cosmos_client.CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
-        database = cosmos_client_instance.get_database_client(COSMOS_DATABASE_NAME)
-        container = database.get_container_client(COSMOS_CONTAINER_NAME)
-        
-        # Try to read the item directly
-        try:
-            item = container.read_item(item=record_id, partition_key=record_id)
-            return item
-        except Exception:
-            # If direct read fails, try querying
-            query = f"SELECT * FROM c WHERE c.id = '{record_id}'"
-            items = list(container.query_items(query=query, enable_cross_partition_query=True))
-            return items[0] if items else None
-            
-    except Exception as e:
-        logging.error(f'Error retrieving from Cosmos DB: {str(e)}')
+        return await container.read_item(item=record_id, partition_key=record_id)
+    except CosmosResourceNotFoundError:
         return None
 
-def get_from_blob_storage(record_id):
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def load_zstd_dictionary():
+    """
+    Load the optional shared zstd dictionary used by the archival writer.
+    """
+    dict_path = os.environ.get('ZSTD_DICT_PATH')
+    if dict_path and os.path.exists(dict_path):
+        with open(dict_path, 'rb') as f:
+            return zstd.ZstdCompressionDict(f.read())
+    return None
+
+_ZSTD_DICT = load_zstd_dictionary()
+
+def decompress_record_data(compressed_data):
     """
-    Retrieve a record from Blob Storage.
+    Decompress an archived record, handling both current zstd frames and
+    legacy gzip blobs by sniffing the magic bytes.
+    """
+    if compressed_data[:4] == ZSTD_MAGIC:
+        # decompressobj does not require a content size in the frame
+        # header, which frames streamed into older packs omit
+        return zstd.ZstdDecompressor(dict_data=_ZSTD_DICT).decompressobj().decompress(compressed_data)
+    return gzip.decompress(compressed_data)
+
+async def stream_decompress_blob(downloader):
+    """
+    Decompress a full-blob download incrementally, feeding each network
+    chunk straight into a decompressor instead of buffering the whole
+    compressed payload first. Peak memory is the decompressed size plus
+    one chunk rather than compressed plus decompressed.
+    """
+    decompressor = None
+    pieces = []
+    async for chunk in downloader.chunks():
+        if decompressor is None:
+            if chunk[:4] == ZSTD_MAGIC:
+                decompressor = zstd.ZstdDecompressor(dict_data=_ZSTD_DICT).decompressobj()
+            else:
+                # 16 + MAX_WBITS tells zlib to expect a gzip header
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pieces.append(decompressor.decompress(chunk))
+    return b''.join(pieces)
+
+async def get_archive_index_entry(record_id):
+    """
+    Look up the archive index entry mapping a record id to its byte range
+    inside an archive pack blob.
     """
     try:
-        blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
-        blob_container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
-        
-        # Construct blob name
+        _, index_container = await get_cosmos_containers()
+
+        return await index_container.read_item(item=record_id, partition_key=record_id)
+    except Exception:
+        return None
+
+async def _fetch_archived_bytes(record_id):
+    """
+    Fetch and decompress an archived record's payload, serving repeats
+    from the in-process cache. Returns None when no archive blob exists.
+    """
+    cached = _archived_bytes_cache.get(record_id)
+    if cached is not None:
+        return cached
+
+    blob_container_client = await get_blob_container()
+
+    index_entry = await get_archive_index_entry(record_id)
+
+    if index_entry:
+        # Ranged read of the record's frame inside the pack
+        blob_client = blob_container_client.get_blob_client(index_entry['blob_name'])
+        downloader = await blob_client.download_blob(
+            offset=index_entry['offset'],
+            length=index_entry['length']
+        )
+        compressed_data = await downloader.readall()
+        decompressed_data = decompress_record_data(compressed_data)
+    else:
+        # Legacy layout: one blob per record, stream-decompressed so
+        # the compressed payload is never buffered whole
         blob_name = f"billing-records/{record_id}.json.gz"
-        
-        # Download and decompress the blob
         blob_client = blob_container_client.get_blob_client(blob_name)
-        
-        if not blob_client.exists():
+
+        # Download directly and let a 404 signal the miss - an
+        # upfront exists() check would cost an extra round-trip
+        try:
+            downloader = await blob_client.download_blob()
+        except ResourceNotFoundError:
             return None
-        
-        # Download the compressed data
-        compressed_data = blob_client.download_blob().readall()
-        
-        # Decompress and parse JSON
-        decompressed_data = gzip.decompress(compressed_data)
-        record = json.loads(decompressed_data.decode('utf-8'))
-        
+        decompressed_data = await stream_decompress_blob(downloader)
+
+    _archived_bytes_cache[record_id] = decompressed_data
+    return decompressed_data
+
+async def get_from_blob_storage(record_id):
+    """
+    Retrieve a record from Blob Storage. Records archived into coalesced
+    packs are fetched with a ranged GET of just their byte range; records
+    archived before the pack layout fall back to their per-record blob.
+    """
+    try:
+        decompressed_data = await _fetch_archived_bytes(record_id)
+        if decompressed_data is None:
+            return None
+
+        record = orjson.loads(decompressed_data)
+
         # Add metadata about retrieval
         record['_retrieved_from_archive'] = True
-        record['_retrieval_timestamp'] = datetime.utcnow().isoformat()
-        
+        record['_retrieval_timestamp'] = datetime.now(timezone.utc).isoformat()
+
         return record
-        
+
     except Exception as e:
         logging.error(f'Error retrieving from Blob Storage: {str(e)}')
         return None
 
-def batch_retrieve(req: func.HttpRequest) -> func.HttpResponse:
+async def _fetch_pack_group(blob_name, group):
+    """
+    Fetch every requested frame in one pack blob with a single ranged GET
+    covering the group's span, then slice the per-record frames locally.
+    Frames are compressed independently, so each slice decompresses on
+    its own. Packs hold contiguous frames from one archival batch, so
+    the covering span stays tight.
+    """
+    try:
+        blob_container_client = await get_blob_container()
+        start = min(entry['offset'] for _, entry in group)
+        end = max(entry['offset'] + entry['length'] for _, entry in group)
+
+        blob_client = blob_container_client.get_blob_client(blob_name)
+        downloader = await blob_client.download_blob(offset=start, length=end - start)
+        data = await downloader.readall()
+
+        payloads = {}
+        for record_id, entry in group:
+            frame = data[entry['offset'] - start:entry['offset'] - start + entry['length']]
+            decompressed_data = decompress_record_data(frame)
+            _archived_bytes_cache[record_id] = decompressed_data
+            payloads[record_id] = decompressed_data
+        return payloads
+    except Exception as e:
+        logging.error(f'Error fetching pack {blob_name}: {str(e)}')
+        return {}
+
+async def batch_fetch_archived_records(record_ids):
+    """
+    Resolve many archived records with as few blob reads as possible:
+    ids located in the same pack are grouped and fetched with one ranged
+    GET per pack; only legacy per-record blobs cost a request each.
+    """
+    payloads = {}
+    uncached_ids = []
+    for record_id in record_ids:
+        cached = _archived_bytes_cache.get(record_id)
+        if cached is not None:
+            payloads[record_id] = cached
+        else:
+            uncached_ids.append(record_id)
+
+    legacy_ids = []
+    if uncached_ids:
+        index_entries = await asyncio.gather(
+            *(get_archive_index_entry(record_id) for record_id in uncached_ids)
+        )
+
+        pack_groups = {}
+        for record_id, entry in zip(uncached_ids, index_entries):
+            if entry:
+                pack_groups.setdefault(entry['blob_name'], []).append((record_id, entry))
+            else:
+                legacy_ids.append(record_id)
+
+        if pack_groups:
+            group_payloads = await asyncio.gather(
+                *(_fetch_pack_group(blob_name, group) for blob_name, group in pack_groups.items())
+            )
+            for group_result in group_payloads:
+                payloads.update(group_result)
+
+    # One timestamp covers the whole batch; stamping happens after the
+    # byte cache so cached payloads stay free of request metadata
+    retrieval_timestamp = datetime.now(timezone.utc).isoformat()
+
+    records = {}
+    for record_id, payload in payloads.items():
+        record = orjson.loads(payload)
+        record['_retrieved_from_archive'] = True
+        record['_retrieval_timestamp'] = retrieval_timestamp
+        records[record_id] = record
+
+    if legacy_ids:
+        legacy_records = await asyncio.gather(
+            *(get_from_blob_storage(record_id) for record_id in legacy_ids)
+        )
+        for record_id, record in zip(legacy_ids, legacy_records):
+            if record:
+                records[record_id] = record
+
+    return records
+
+async def query_records_by_ids(record_ids):
+    """
+    Fetch multiple records from Cosmos DB with parameterized IN queries
+    (chunks of 100 ids) instead of one point-read per id.
+    """
+    container, _ = await get_cosmos_containers()
+    records = {}
+
+    for i in range(0, len(record_ids), 100):
+        chunk = record_ids[i:i + 100]
+        parameters = [{"name": f"@id{j}", "value": record_id} for j, record_id in enumerate(chunk)]
+        placeholders = ",".join(parameter["name"] for parameter in parameters)
+        query = f"SELECT * FROM c WHERE c.id IN ({placeholders})"
+
+        async for item in container.query_items(query=query, parameters=parameters):
+            records[item['id']] = item
+
+    return records
+
+async def batch_retrieve(req: func.HttpRequest) -> func.HttpResponse:
     """
     Function to handle batch retrieval of multiple records.
     """
     logging.info('Processing batch billing record retrieval request')
-    
+
     try:
         req_body = req.get_json()
         if not req_body or 'ids' not in req_body:
-            return func.HttpResponse(
-                json.dumps({"error": "Record IDs list is required"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
+            return json_response(req, {"error": "Record IDs list is required"}, status_code=400)
+
         record_ids = req_body['ids']
         if not isinstance(record_ids, list):
-            return func.HttpResponse(
-                json.dumps({"error": "Record IDs must be a list"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
+            return json_response(req, {"error": "Record IDs must be a list"}, status_code=400)
+
         results = {}
-        
-        for record_id in record_ids:
-            # Try Cosmos DB first
-            record = get_from_cosmos_db(record_id)
-            
-            if not record:
-                # Try archived storage
-                record = get_from_blob_storage(record_id)
-            
-            if record:
-                results[record_id] = record
-            else:
-                results[record_id] = {"error": "Record not found"}
-        
-        return func.HttpResponse(
-            json.dumps(results, default=str),
-            status_code=200,
-            mimetype="application/json"
-        )
-        
+
+        if record_ids:
+            # One bulk query returns all hot records instead of a read per
+            # id; only the misses go to archived storage, fetched
+            # concurrently on the event loop
+            results.update(await query_records_by_ids(record_ids))
+
+            missing_ids = [record_id for record_id in record_ids if record_id not in results]
+
+            if missing_ids:
+                archived_records = await batch_fetch_archived_records(missing_ids)
+                for record_id in missing_ids:
+                    record = archived_records.get(record_id)
+                    results[record_id] = record if record else {"error": "Record not found"}
+
+        return json_response(req, results)
+
     except Exception as e:
         logging.error(f'Error in batch retrieval: {str(e)}')
-        return func.HttpResponse(
-            json.dumps({"error": "Internal server error"}),
-            status_code=500,
-            mimetype="application/json"
-        )
-
+        return json_response(req, {"error": "Internal server error"}, status_code=500)